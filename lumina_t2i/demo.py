@@ -1,16 +1,22 @@
 import argparse
 import builtins
+import functools
+import itertools
 import json
-import multiprocessing as mp
 import os
+import queue
 import socket
+import threading
 import traceback
 
 import fairscale.nn.model_parallel.initialize as fs_init
 import gradio as gr
 import torch
 import torch.distributed as dist
-from torchvision.transforms.functional import to_pil_image
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from PIL import Image
+from torch.nn.utils.rnn import pad_sequence
 
 import models
 from transport import create_transport, Sampler
@@ -19,29 +25,37 @@ from transport import create_transport, Sampler
 class ModelFailure: pass
 
 
-@torch.no_grad()
-def model_main(args, master_port, rank, request_queue, response_queue, mp_barrier):
-    # import here to avoid huggingface Tokenizer parallelism warnings
-    from diffusers.models import AutoencoderKL
-    from transformers import AutoModelForCausalLM, AutoTokenizer
+# the masked cross-attention (and the fp32 self-attention) of the DiT go through F.scaled_dot_product_attention;
+# restricting it to the fused kernels keeps it from silently falling back to the quadratic math implementation
+fused_sdpa = functools.partial(
+    torch.backends.cuda.sdp_kernel, enable_flash=True, enable_mem_efficient=True, enable_math=False
+)
 
-    # override the default print function since the delay can be large for child process
-    original_print = builtins.print
+# solvers on a fixed time grid, whose per-sample results do not depend on the rest of the batch
+FIXED_STEP_SOLVERS = {"euler"}
 
-    # Redefine the print function with flush=True by default
-    def print(*args, **kwargs):
-        kwargs.setdefault('flush', True)
-        original_print(*args, **kwargs)
+# caption features are padded to one of these lengths, which bounds the shapes the compiled DiT is specialized on
+CAP_LEN_BUCKETS = [32, 64, 128, 256]
 
-    # Override the built-in print with the new version
-    builtins.print = print
+RESOLUTION_CHOICES = (
+    ["1024x1024", "512x2048", "2048x512"] +
+    ["(Extrapolation) 1664x1664", "(Extrapolation) 1024x2048", "(Extrapolation) 2048x1024"]
+)
 
-    os.environ["MASTER_PORT"] = str(master_port)
-    os.environ["MASTER_ADDR"] = "127.0.0.1"
-    os.environ["RANK"] = str(rank)
-    os.environ["WORLD_SIZE"] = str(args.num_gpus)
 
-    dist.init_process_group("nccl")
+@torch.no_grad()
+def model_main(args, master_port, rank, request_queue, response_queue, mp_barrier):
+    # import here to avoid huggingface Tokenizer parallelism warnings
+    from diffusers.models import AutoencoderKL
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+    # no collectives are issued for single-GPU inference, so a gloo group saves the NCCL
+    # communicator setup and keeps its streams away from compiled / CUDA graph execution.
+    # the rendezvous is passed explicitly, the worker may share its environment with the UI
+    dist.init_process_group(
+        "nccl" if args.num_gpus > 1 else "gloo",
+        init_method=f"tcp://127.0.0.1:{master_port}", rank=rank, world_size=args.num_gpus,
+    )
     # set up fairscale environment because some methods of the Lumina model need it,
     # though for single-GPU inference fairscale actually has no effect
     fs_init.initialize_model_parallel(args.num_gpus)
@@ -63,7 +77,17 @@ def model_main(args, master_port, rank, request_queue, response_queue, mp_barrie
         "fp32": torch.float32
     }[args.precision]
 
-    model_lm = AutoModelForCausalLM.from_pretrained(train_args.lm, torch_dtype=dtype, device_map="cuda")
+    # only build the selected config, BitsAndBytesConfig requires bitsandbytes to be installed
+    quantization_config = None
+    if args.lm_quant == "int8":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    elif args.lm_quant == "nf4":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=dtype
+        )
+    model_lm = AutoModelForCausalLM.from_pretrained(
+        train_args.lm, torch_dtype=dtype, device_map="cuda", quantization_config=quantization_config
+    )
     cap_feat_dim = model_lm.config.hidden_size
     if args.num_gpus > 1:
         raise NotImplementedError("Inference with >1 GPUs not yet supported")
@@ -71,14 +95,35 @@ def model_main(args, master_port, rank, request_queue, response_queue, mp_barrie
     tokenizer = AutoTokenizer.from_pretrained(train_args.tokenizer_path, add_bos_token=True, add_eos_token=True)
     tokenizer.padding_side = 'right'
 
+    # only the hidden states of a single forward pass are needed, so the KV cache is never materialized
+    lm_decoder = model_lm.get_decoder()
+
+    # users often resubmit a caption with different settings, so the LLM features of recent captions are cached
+    @functools.lru_cache(maxsize=32)
+    def encode_cap(cap):
+        cap_enc = tokenizer(cap, truncation=False, return_tensors="pt")
+        cap_tok = cap_enc.input_ids.cuda(non_blocking=True)
+        return lm_decoder(input_ids=cap_tok, use_cache=False).last_hidden_state[0], cap_enc.attention_mask[0]
+
+    # the empty caption used for classifier-free guidance never changes, so its features are kept for good
+    null_cap_feats, null_cap_mask = encode_cap("")
+
     if dist.get_rank() == 0:
         print(f"Creating vae: {train_args.vae}")
+    # the SD VAEs are prone to overflow in fp16, so the VAE only follows the DiT precision for bf16 / fp32
+    vae_dtype = torch.float32 if dtype == torch.float16 else dtype
     vae = AutoencoderKL.from_pretrained(
         f"stabilityai/sd-vae-ft-{train_args.vae}"
         if train_args.vae != "sdxl"
         else "stabilityai/sdxl-vae",
-        torch_dtype=torch.float32
+        torch_dtype=vae_dtype
     ).cuda()
+    # NHWC lets cuDNN and Inductor pick Tensor Core conv kernels without layout transposes
+    vae.to(memory_format=torch.channels_last)
+    if args.compile:
+        # Inductor specializes the decoder on the latent shape, so the first request at each
+        # new resolution or batch size pays a one-time recompilation
+        vae.decode = torch.compile(vae.decode, mode="max-autotune", dynamic=False)
 
     if dist.get_rank() == 0:
         print(f"Creating DiT: {train_args.model}")
@@ -90,30 +135,106 @@ def model_main(args, master_port, rank, request_queue, response_queue, mp_barrie
     model.eval().to("cuda", dtype=dtype)
 
     assert train_args.model_parallel_size == args.num_gpus
+    # mmap the checkpoint so tensors are paged in one at a time while load_state_dict copies
+    # (and casts) them into the GPU parameters, instead of materializing the whole file in host memory
     ckpt = torch.load(os.path.join(
         args.ckpt, f"consolidated{'_ema' if args.ema else ''}.{rank:02d}-of-{args.num_gpus:02d}.pth"
-    ), map_location="cpu")
+    ), map_location="cpu", mmap=True, weights_only=True)
     model.load_state_dict(ckpt, strict=True)
 
+    # the resolution dependent sampling arguments are fixed per dropdown entry, so they are computed once
+    resolution_table = {}
+    for res in RESOLUTION_CHOICES:
+        w, h = res.split(" ")[-1].split("x")
+        w, h = int(w), int(h)
+        resolution_table[res] = dict(
+            latent_size=(h // 8, w // 8),
+            base_seqlen=(train_args.image_size // 16) ** 2 + (train_args.image_size // 16) * 2,
+            ntk_factor=((w // 16) * (h // 16)) / ((train_args.image_size // 16) ** 2),
+        )
+
+    if args.compile:
+        torch.set_float32_matmul_precision("high")
+        torch._inductor.config.conv_1x1_as_mm = True
+        # dynamo keeps one entry per caption length, batch size, resolution and ntk / proportional attention
+        # setting, and silently falls back to eager past cache_size_limit; twice the buckets leaves room
+        # for captions longer than the largest one
+        num_variants = 2 * len(CAP_LEN_BUCKETS) * args.max_batch * len(RESOLUTION_CHOICES) * 4
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, num_variants)
+        if hasattr(torch._dynamo.config, "accumulated_cache_size_limit"):
+            torch._dynamo.config.accumulated_cache_size_limit = max(
+                torch._dynamo.config.accumulated_cache_size_limit, num_variants
+            )
+        compiled_forward_with_cfg = torch.compile(model.forward_with_cfg, mode="reduce-overhead", dynamic=False)
+
+        def forward_with_cfg(*args, **kwargs):
+            # every CUDA graph replay overwrites the outputs of the previous one, while the adaptive
+            # solvers (dopri5 / dopri8) hold on to earlier drift evaluations, so each output is copied out
+            torch.compiler.cudagraph_mark_step_begin()
+            return compiled_forward_with_cfg(*args, **kwargs).clone()
+
+        model.forward_with_cfg = forward_with_cfg
+
+        # warm up every batch size and caption length bucket at the default resolution so that the
+        # compilation costs do not hit user requests; repeated calls record the CUDA graphs
+        if dist.get_rank() == 0:
+            print(f"Warming up compiled DiT at {RESOLUTION_CHOICES[0]} for batch sizes 1-{args.max_batch} "
+                  f"and caption lengths {CAP_LEN_BUCKETS}")
+        res_cfg = resolution_table[RESOLUTION_CHOICES[0]]
+        with torch.inference_mode():
+            for batch_size in range(1, args.max_batch + 1):
+                # requests start from contiguous noise under --compile
+                z = torch.randn([2 * batch_size, 4, *res_cfg["latent_size"]], device="cuda", dtype=dtype)
+                t = torch.ones([2 * batch_size], device="cuda")
+                for cap_len in CAP_LEN_BUCKETS:
+                    cap_feats, cap_mask = pad_caps(
+                        [null_cap_feats] * (2 * batch_size), [null_cap_mask] * (2 * batch_size), cap_len
+                    )
+                    with torch.autocast("cuda", dtype), fused_sdpa():
+                        for _ in range(2):
+                            model.forward_with_cfg(
+                                z, t, cap_feats=cap_feats, cap_mask=cap_mask,
+                                cfg_scale=torch.tensor(4., device="cuda"), proportional_attn=True,
+                                base_seqlen=res_cfg["base_seqlen"], ntk_factor=res_cfg["ntk_factor"],
+                            )
+                # the decoder is specialized on the batch size as well, and a max-autotune compile
+                # can take minutes, so it must not happen while serving. the input matches the contiguous
+                # latents that requests decode, independent of the noise layout used for the DiT
+                vae.decode(torch.randn([batch_size, 4, *res_cfg["latent_size"]], device="cuda", dtype=vae_dtype))
+        torch.cuda.synchronize()
+
+    # a device-local generator keeps seeding off the global RNG state
+    generator = torch.Generator(device="cuda")
+
     mp_barrier.wait()
 
-    with torch.autocast("cuda", dtype):
+    # the transport only depends on the command line arguments, requests merely pick the ODE settings
+    transport = create_transport(
+        args.path_type,
+        args.prediction,
+        args.loss_weight,
+        args.train_eps,
+        args.sample_eps
+    )
+    sampler = Sampler(transport)
+
+    deferred_request = None
+    # requests run under inference_mode, which skips the version counter and view tracking that
+    # no_grad still does; model loading keeps no_grad so that no parameters become inference tensors.
+    # autocast only covers the DiT, the LLM and the VAE run in the dtype they were loaded in
+    with torch.inference_mode():
         while True:
+            first_request = deferred_request if deferred_request is not None else request_queue.get()
+            batch, deferred_request = collect_batch(request_queue, first_request, args.max_batch)
+            request_ids = [request[0] for request in batch]
+            caps = [request[1] for request in batch]
+            seeds = [request[7] for request in batch]
             (
-                cap, resolution, num_sampling_steps, cfg_scale, solver, t_shift, seed, ntk_scaling, proportional_attn
-            ) = request_queue.get()
+                resolution, num_sampling_steps, cfg_scale, solver, t_shift, ntk_scaling, proportional_attn
+            ) = sampling_key(batch[0])
 
             try:
                 # begin sampler
-                transport = create_transport(
-                    args.path_type,
-                    args.prediction,
-                    args.loss_weight,
-                    args.train_eps,
-                    args.sample_eps
-
-                )
-                sampler = Sampler(transport)
                 sample_fn = sampler.sample_ode(
                     sampling_method=solver,
                     num_steps=num_sampling_steps,
@@ -124,56 +245,155 @@ def model_main(args, master_port, rank, request_queue, response_queue, mp_barrie
                 )
                 # end sampler
 
-                resolution = resolution.split(" ")[-1]
-                w, h = resolution.split("x")
-                w, h = int(w), int(h)
-                latent_w, latent_h = w // 8, h // 8
-                if int(seed) != 0:
-                    torch.random.manual_seed(int(seed))
-                z = torch.randn([1, 4, latent_h, latent_w], device="cuda").to(dtype)
-                z = z.repeat(2, 1, 1, 1)
-
-                cap_tok = tokenizer.encode(cap, truncation=False)
-                null_cap_tok = tokenizer.encode("", truncation=False)
-                tok = torch.zeros([2, max(len(cap_tok), len(null_cap_tok))], dtype=torch.long, device="cuda")
-                tok_mask = torch.zeros_like(tok, dtype=torch.bool)
-                tok[0, :len(cap_tok)] = torch.tensor(cap_tok)
-                tok[1, :len(null_cap_tok)] = torch.tensor(null_cap_tok)
-                tok_mask[0, :len(cap_tok)] = True
-                tok_mask[1, :len(null_cap_tok)] = True
-
-                cap_feats = model_lm.get_decoder()(input_ids=tok).last_hidden_state
+                res_cfg = resolution_table[resolution]
+                latent_h, latent_w = res_cfg["latent_size"]
+                noise = []
+                for seed in seeds:
+                    if int(seed) != 0:
+                        generator.manual_seed(int(seed))
+                    else:
+                        generator.seed()
+                    noise.append(torch.randn(
+                        [1, 4, latent_h, latent_w], device="cuda", dtype=dtype, generator=generator
+                    ))
+                # forward_with_cfg only reads the first half of the CFG pair, so the noise is broadcast
+                # rather than copied (the result stays a view for a single request)
+                z = torch.cat(noise)[None].expand(2, -1, -1, -1, -1).flatten(0, 1)
+                if args.compile:
+                    # the solver states are contiguous, so a contiguous start keeps the compiled DiT
+                    # to a single input layout
+                    z = z.contiguous()
+
+                cap_feats_list, cap_mask_list = [], []
+                for cap in caps:
+                    cap_feats, cap_mask = encode_cap(cap)
+                    cap_feats_list.append(cap_feats)
+                    cap_mask_list.append(cap_mask)
+                # forward_with_cfg expects all conditional rows first, followed by the unconditional ones
+                cap_feats_list += [null_cap_feats] * len(caps)
+                cap_mask_list += [null_cap_mask] * len(caps)
+
+                # pad the captions and the cached null captions into the CFG pairs
+                cap_feats, tok_mask = pad_caps(
+                    cap_feats_list, cap_mask_list, cap_len_bucket(max(len(feats) for feats in cap_feats_list))
+                )
 
                 model_kwargs = dict(
-                    cap_feats=cap_feats, cap_mask=tok_mask, cfg_scale=cfg_scale,
+                    # a tensor rather than a Python float, which the compiled DiT would specialize on
+                    cap_feats=cap_feats, cap_mask=tok_mask, cfg_scale=torch.tensor(cfg_scale, device="cuda"),
                 )
                 if proportional_attn:
                     model_kwargs['proportional_attn'] = True
-                    model_kwargs['base_seqlen'] = (train_args.image_size // 16) ** 2 + (train_args.image_size // 16) * 2
+                    model_kwargs['base_seqlen'] = res_cfg["base_seqlen"]
                 if ntk_scaling:
-                    model_kwargs['ntk_factor'] = ((w // 16) * (h // 16)) / ((train_args.image_size // 16) ** 2)
+                    model_kwargs['ntk_factor'] = res_cfg["ntk_factor"]
 
                 if dist.get_rank() == 0:
-                    print(f"caption: {cap}")
+                    for cap in caps:
+                        print(f"caption: {cap}")
                     print(f"num_sampling_steps: {num_sampling_steps}")
                     print(f"cfg_scale: {cfg_scale}")
 
-                samples = sample_fn(z, model.forward_with_cfg, **model_kwargs)[-1]
-                samples = samples[:1]
+                with torch.autocast("cuda", dtype), fused_sdpa():
+                    samples = sample_fn(z, model.forward_with_cfg, **model_kwargs)[-1]
+                samples = samples[:len(batch)]
 
                 factor = 0.18215 if train_args.vae != 'sdxl' else 0.13025
                 print(f"vae factor: {factor}")
-                samples = vae.decode(samples / factor).sample
-                samples = (samples + 1.) / 2.
-                samples.clamp_(0., 1.)
-                img = to_pil_image(samples[0])
+                samples = vae.decode((samples / factor).to(vae_dtype)).sample.float()
+                # convert to HWC uint8 on the GPU so that only a quarter of the bytes cross PCIe
+                samples = samples.clamp(-1., 1.).add(1.).mul(127.5).to(torch.uint8)
+                samples = samples.permute(0, 2, 3, 1).contiguous()
 
                 if response_queue is not None:
-                    response_queue.put(img)
+                    # stage the results in pinned memory so that the device-to-host copies of the whole
+                    # batch are issued asynchronously and waited on only once
+                    results = [
+                        torch.empty(sample.shape, dtype=sample.dtype, pin_memory=True).copy_(sample, non_blocking=True)
+                        for sample in samples
+                    ]
+                    torch.cuda.current_stream().synchronize()
+                    # for a worker process, torch.multiprocessing hands the tensors over through shared memory
+                    # instead of pickling images; the UI wraps them into PIL images
+                    for request_id, result in zip(request_ids, results):
+                        response_queue.put((request_id, result))
 
             except Exception:
                 print(traceback.format_exc())
-                response_queue.put(ModelFailure())
+                for request_id in request_ids:
+                    response_queue.put((request_id, ModelFailure()))
+
+
+def cap_len_bucket(length):
+    for bucket in CAP_LEN_BUCKETS:
+        if length <= bucket:
+            return bucket
+    # captions longer than the largest bucket are rare, they are rounded up to a multiple of it
+    return -(-length // CAP_LEN_BUCKETS[-1]) * CAP_LEN_BUCKETS[-1]
+
+
+def pad_caps(cap_feats_list, cap_mask_list, length):
+    """
+    Pad per-caption features [L, D] and attention masks [L] into a batch of the given length.
+    The padded positions are masked out, so the length only affects the shapes the DiT sees.
+    """
+    cap_feats = pad_sequence(cap_feats_list, batch_first=True)
+    cap_mask = pad_sequence(cap_mask_list, batch_first=True)
+    cap_feats = F.pad(cap_feats, (0, 0, 0, length - cap_feats.shape[1]))
+    cap_mask = F.pad(cap_mask, (0, length - cap_mask.shape[1]))
+    return cap_feats, cap_mask.bool().cuda(non_blocking=True)
+
+
+def model_worker(args, master_port, rank, request_queue, response_queue, mp_barrier):
+    try:
+        model_main(args, master_port, rank, request_queue, response_queue, mp_barrier)
+    except BaseException:
+        # release the UI process waiting on the barrier, otherwise a failed startup blocks it forever
+        mp_barrier.abort()
+        raise
+
+
+def model_process_main(args, master_port, rank, request_queue, response_queue, mp_barrier):
+    # override the default print function since the delay can be large for child process
+    original_print = builtins.print
+
+    # Redefine the print function with flush=True by default
+    def print(*args, **kwargs):
+        kwargs.setdefault('flush', True)
+        original_print(*args, **kwargs)
+
+    # Override the built-in print with the new version
+    builtins.print = print
+
+    model_worker(args, master_port, rank, request_queue, response_queue, mp_barrier)
+
+
+def sampling_key(request):
+    # everything but the request id, the caption and the seed has to match for requests to share a batch
+    _, _, resolution, num_sampling_steps, cfg_scale, solver, t_shift, _, ntk_scaling, proportional_attn = request
+    return resolution, num_sampling_steps, cfg_scale, solver, t_shift, ntk_scaling, proportional_attn
+
+
+def collect_batch(request_queue, first_request, max_batch):
+    """
+    Drain the requests queued behind ``first_request`` that can be sampled together with it.
+    Returns the batch and the first incompatible request (or None), which starts the next batch.
+    """
+    batch = [first_request]
+    # adaptive solvers pick one step size for the whole batch, so a request would no longer be
+    # reproducible from its caption and seed if it shared the batch with others
+    solver = sampling_key(first_request)[3]
+    if solver not in FIXED_STEP_SOLVERS:
+        return batch, None
+    while len(batch) < max_batch:
+        try:
+            request = request_queue.get_nowait()
+        except queue.Empty:
+            break
+        if sampling_key(request) != sampling_key(first_request):
+            return batch, request
+        batch.append(request)
+    return batch, None
 
 
 def none_or_str(value):
@@ -230,6 +450,19 @@ def main():
     parser.add_argument("--ckpt", type=str, required=True)
     parser.add_argument("--ema", action="store_true")
     parser.add_argument("--precision", default="bf16", choices=["bf16", "fp32"])
+    parser.add_argument("--lm-quant", default="none", choices=["none", "int8", "nf4"],
+                        help="weight-only quantization of the text encoder (requires bitsandbytes); "
+                             "nf4 is preferred as int8 can be slower than bf16 at small batch sizes")
+    parser.add_argument("--max-batch", type=int, default=1,
+                        help="maximum number of concurrent requests with identical sampling settings "
+                             "that are generated in one batch; only applies to the fixed-step euler solver, "
+                             "adaptive solvers always run one request at a time")
+    parser.add_argument("--compile", action="store_true",
+                        help="compile the DiT (mode=reduce-overhead) and the VAE decoder (mode=max-autotune) "
+                             "with torch.compile; startup warms up the default resolution for every batch size and "
+                             "caption length bucket, other resolutions, ntk scaling / proportional attention "
+                             f"settings and captions longer than {CAP_LEN_BUCKETS[-1]} tokens trigger a one-time "
+                             "recompilation")
 
     parse_transport_args(parser)
     parse_ode_args(parser)
@@ -241,16 +474,38 @@ def main():
 
     master_port = find_free_port()
 
-    processes = []
-    request_queues = []
-    response_queue = mp.Queue()
-    mp_barrier = mp.Barrier(args.num_gpus + 1)
-    for i in range(args.num_gpus):
-        request_queues.append(mp.Queue())
-        p = mp.Process(target=model_main,
-                       args=(args, master_port, i, request_queues[i], response_queue if i == 0 else None, mp_barrier))
-        p.start()
-        processes.append(p)
+    if args.num_gpus == 1:
+        # a single model needs no worker process: run it in a thread of the Gradio process, which
+        # saves the process spawn, a second interpreter and the IPC of every request and result
+        request_queues = [queue.Queue()]
+        response_queue = queue.Queue()
+        mp_barrier = threading.Barrier(2)
+        threading.Thread(
+            target=model_worker, args=(args, master_port, 0, request_queues[0], response_queue, mp_barrier), daemon=True
+        ).start()
+    else:
+        processes = []
+        request_queues = []
+        response_queue = mp.Queue()
+        mp_barrier = mp.Barrier(args.num_gpus + 1)
+        for i in range(args.num_gpus):
+            request_queues.append(mp.Queue())
+            p = mp.Process(target=model_process_main,
+                           args=(args, master_port, i, request_queues[i], response_queue if i == 0 else None, mp_barrier))
+            p.start()
+            processes.append(p)
+
+    # concurrent submissions may be batched and answered out of order, so results are routed
+    # back to the waiting callers by request id
+    request_ids = itertools.count()
+    pending_results = {}
+
+    def dispatch_results():
+        while True:
+            request_id, result = response_queue.get()
+            pending_results.pop(request_id).put(result)
+
+    threading.Thread(target=dispatch_results, daemon=True).start()
 
     with gr.Blocks() as demo:
         with gr.Row():
@@ -261,7 +516,11 @@ def main():
  
 **ema**: {args.ema}
                 
-**precision**: {args.precision}"""
+**precision**: {args.precision}
+
+**lm quantization**: {args.lm_quant}
+
+**compile**: {args.compile}"""
             )
         with gr.Row():
             with gr.Column():
@@ -271,13 +530,9 @@ def main():
                           "illustrated in the style of Hayao Miyazaki anime by Studio Ghibli."
                 )
                 with gr.Row():
-                    res_choices = (
-                        ["1024x1024", "512x2048", "2048x512"] +
-                        ["(Extrapolation) 1664x1664", "(Extrapolation) 1024x2048", "(Extrapolation) 2048x1024"]
-                    )
                     resolution = gr.Dropdown(
-                        value=res_choices[0],
-                        choices=res_choices,
+                        value=RESOLUTION_CHOICES[0],
+                        choices=RESOLUTION_CHOICES,
                         label="Resolution"
                     )
                 with gr.Row():
@@ -341,12 +596,15 @@ def main():
             )
 
         def on_submit(*args):
+            request_id = next(request_ids)
+            result_queue = queue.Queue(maxsize=1)
+            pending_results[request_id] = result_queue
             for q in request_queues:
-                q.put(args)
-            result = response_queue.get()
+                q.put((request_id, *args))
+            result = result_queue.get()
             if isinstance(result, ModelFailure):
                 raise RuntimeError
-            return result
+            return Image.fromarray(result.numpy())
 
         submit_btn.click(
             on_submit,
@@ -354,8 +612,11 @@ def main():
             [output_img]
         )
 
-    mp_barrier.wait()
-    demo.queue().launch(
+    try:
+        mp_barrier.wait()
+    except threading.BrokenBarrierError:
+        raise RuntimeError("Failed to load the model, see the traceback of the model worker above") from None
+    demo.queue(default_concurrency_limit=args.max_batch).launch(
         share=True, server_name="0.0.0.0",
     )
 